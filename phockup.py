@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
 import logging
 import logging.handlers
 import os
+import queue
 import re
 import sys
 
 from src.date import Date
 from src.dependency import check_dependencies
 from src.phockup import Phockup
+from src.progress import ProgressHandler
 
 __version__ = '1.6.1'
 
@@ -25,6 +28,14 @@ DEFAULT_DIR_FORMAT = ['%Y', '%m', '%d']
 logger = logging.getLogger('phockup')
 
 
+def positive_int(value):
+    """Argument type for integers of at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a positive integer")
+    return number
+
+
 def parse_args(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(
         description=PROGRAM_DESCRIPTION,
@@ -134,6 +145,36 @@ Descend at most 'maxdepth' levels (a non-negative integer) of directories
 """,
     )
 
+    parser.add_argument(
+        '--no-reflink',
+        action='store_false',
+        dest='reflink',
+        help="""\
+When copying, always copy the file content. By default files on the same copy-on-write
+file system (e.g. btrfs, xfs) are cloned and share their content until modified.
+""",
+    )
+
+    parser.add_argument(
+        '--hash',
+        choices=['blake3', 'xxh3', 'blake2b', 'sha256'],
+        help="""\
+Hash algorithm used to check if a file with the same name is a duplicate.
+Only files larger than 256 MiB are hashed, smaller ones are compared byte
+by byte. Defaults to the fastest one available. blake3 and xxh3 need the Python packages
+blake3 and xxhash to be installed.
+""",
+    )
+
+    parser.add_argument(
+        '--max-workers',
+        type=positive_int,
+        metavar='N',
+        help="""\
+Process at most N files in parallel (a positive integer). Defaults to the number of CPUs.
+""",
+    )
+
     parser.add_argument(
         '-r',
         '--regex',
@@ -191,6 +232,16 @@ Run without output.
 """,
     )
 
+    parser.add_argument(
+        '--progress',
+        action='store_true',
+        default=False,
+        help="""\
+Show the number of processed files on a single status line instead of a line per file.
+Messages for each file are still written to the log file if `--log` is used.
+""",
+    )
+
     parser.add_argument(
         '--log',
         action='store',
@@ -232,14 +283,25 @@ videos only, use `--file-type=[image|video]`.
 
 
 def setup_logging(options):
-    """Configure logging."""
+    """
+    Configure logging.
+    Records are passed through a queue to a single listener thread writing
+    them, so worker threads do not wait for the console or the log file.
+    """
     root = logging.getLogger('')
     root.setLevel(logging.WARNING)
     formatter = logging.Formatter(
         '[%(asctime)s] - [%(levelname)s] - %(message)s', '%Y-%m-%d %H:%M:%S')
-    ch = logging.StreamHandler()
+    if options.progress:
+        ch = ProgressHandler()
+        ch.setLevel(logging.WARNING)
+    else:
+        ch = logging.StreamHandler()
     ch.setFormatter(formatter)
-    root.addHandler(ch)
+    root_queue = queue.Queue()
+    root.addHandler(logging.handlers.QueueHandler(root_queue))
+    listeners = [logging.handlers.QueueListener(
+        root_queue, ch, respect_handler_level=True)]
     if not options.quiet:
         logger.setLevel(options.debug and logging.DEBUG or logging.INFO)
     else:
@@ -248,7 +310,12 @@ def setup_logging(options):
         logfile = os.path.expanduser(options.log)
         fh = logging.FileHandler(logfile)
         fh.setFormatter(formatter)
-        logger.addHandler(fh)
+        log_queue = queue.Queue()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        listeners.append(logging.handlers.QueueListener(log_queue, fh))
+    for listener in listeners:
+        listener.start()
+        atexit.register(listener.stop)
 
 
 def main(options):
@@ -268,6 +335,10 @@ def main(options):
         quiet=options.quiet,
         max_depth=options.maxdepth,
         file_type=options.file_type,
+        reflink=options.reflink,
+        hash=options.hash,
+        max_workers=options.max_workers,
+        progress=options.progress,
     )
 
 
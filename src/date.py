@@ -1,11 +1,54 @@
 import os
 import re
 from datetime import datetime
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def compile_dir_format(dir_format):
+    """
+    Compile dir_format into a function formatting the date of a datetime,
+    so the format is parsed once instead of by strftime for every file.
+    Formats using other than the numeric date directives use strftime,
+    returning None if the platform's strftime rejects the format.
+    """
+    fields = {
+        '%Y': '{d.year:04d}',
+        '%y': '{d.year % 100:02d}',
+        '%m': '{d.month:02d}',
+        '%d': '{d.day:02d}',
+        '%%': '%',
+    }
+    template = ''
+    for part in re.split('(%.)', dir_format):
+        if part in fields:
+            template += fields[part]
+        elif '%' in part:
+            return lambda d: strftime_or_none(d.date(), dir_format)
+        else:
+            template += part.replace('{', '{{').replace('}', '}}')
+
+    return eval(compile(f'lambda d: f{template!r}', '<dir_format>', 'eval'))
+
+
+def strftime_or_none(d, date_format):
+    try:
+        return d.strftime(date_format)
+    except ValueError:
+        return None
+
+
+def format_file_name(d):
+    """
+    Format the date part of generated file names, e.g. 20170101-010101
+    """
+    return f'{d.year:04d}{d.month:02d}{d.day:02d}-{d.hour:02d}{d.minute:02d}{d.second:02d}'
 
 
 class Date():
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, dir_format=None):
         self.filename = filename
+        self.dir_format = dir_format
 
     def parse(self, date):
         date = date.replace('YYYY', '%Y')  # 2017 (year)
@@ -31,6 +74,16 @@ class Date():
 
     def from_exif(self, exif, timestamp=None, user_regex=None,
                   date_field=None):
+        date = self.from_exif_date(exif, timestamp, user_regex, date_field)
+
+        # Format the output directory and file name once for the date
+        if self.dir_format and date and date.get('date') is not None:
+            date['dir_rel'] = compile_dir_format(self.dir_format)(date['date'])
+            date['fn_prefix'] = format_file_name(date['date'])
+        return date
+
+    def from_exif_date(self, exif, timestamp=None, user_regex=None,
+                       date_field=None):
         if date_field:
             keys = date_field.split()
         else:
@@ -1,7 +1,9 @@
 import json
+import os
 import shlex
 import sys
-from subprocess import CalledProcessError, check_output
+import threading
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, check_output
 
 
 class Exif(object):
@@ -9,6 +11,14 @@ class Exif(object):
         self.filename = filename
 
     def data(self):
+        daemon = ExifToolDaemon.active
+        if daemon is not None and daemon.accepts(self.filename):
+            try:
+                return daemon.data(self.filename)
+            except OSError:
+                # exiftool could not be started or exited, run it once instead
+                pass
+
         try:
             if sys.platform == 'win32':
                 exif_command = f'exiftool -time:all -mimetype -j "{self.filename}"'
@@ -20,3 +30,88 @@ class Exif(object):
             return None
 
         return exif
+
+
+class ExifToolDaemon(object):
+    """
+    Keep exiftool running in -stay_open mode while the context is active,
+    so Exif.data() does not start a new exiftool for every file.
+    Every thread gets its own exiftool process.
+    """
+    active = None
+
+    def __init__(self):
+        self.local = threading.local()
+        self.processes = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        ExifToolDaemon.active = self
+        return self
+
+    def __exit__(self, *exc_info):
+        ExifToolDaemon.active = None
+        self.close()
+
+    def accepts(self, filename):
+        """
+        Arguments are passed to exiftool one per line, so file names which
+        exiftool would read differently are left to the one-off command.
+        """
+        return not (filename[:1] in ('-', '#') or filename != filename.strip()
+                    or '\n' in filename or '\r' in filename)
+
+    def process(self):
+        process = getattr(self.local, 'process', None)
+        if process is None:
+            command = ['exiftool', '-stay_open', 'True', '-@', '-', '-common_args',
+                       '-time:all', '-mimetype', '-j']
+            if sys.platform == 'win32':
+                command[-3:-3] = ['-charset', 'filename=utf8']
+            process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+            self.local.process = process
+            with self.lock:
+                self.processes.append(process)
+        return process
+
+    def data(self, filename):
+        if sys.platform == 'win32':
+            filename = filename.encode('UTF-8')
+        else:
+            filename = os.fsencode(filename)
+
+        process = self.process()
+        output = []
+        try:
+            process.stdin.write(filename + b'\n-execute\n')
+            process.stdin.flush()
+
+            for line in iter(process.stdout.readline, b''):
+                if line.rstrip() == b'{ready}':
+                    break
+                output.append(line)
+            else:
+                raise OSError('exiftool exited before finishing the request')
+        except OSError:
+            # Start a new exiftool for the next file of this thread
+            self.local.process = None
+            raise
+
+        try:
+            data = b''.join(output).decode('UTF-8')
+            exif = json.loads(data)[0] if data.strip() else None
+        except UnicodeDecodeError:
+            return None
+
+        return exif
+
+    def close(self):
+        with self.lock:
+            processes, self.processes = self.processes, []
+        for process in processes:
+            try:
+                process.stdin.write(b'-stay_open\nFalse\n')
+                process.stdin.close()
+            except OSError:
+                pass
+            process.wait()
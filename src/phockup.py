@@ -1,18 +1,54 @@
 #!/usr/bin/env python3
+import errno
 import hashlib
 import logging
 import os
-import re
 import shutil
 import sys
-
-from src.date import Date
-from src.exif import Exif
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from src.date import Date, compile_dir_format, format_file_name
+from src.exif import Exif, ExifToolDaemon
+from src.progress import Progress
 
 logger = logging.getLogger('phockup')
 
 
-ignored_files = ('.DS_Store', 'Thumbs.db')
+ignored_files = frozenset(('.DS_Store', 'Thumbs.db'))
+
+# Errors of copy_file_range and sendfile meaning the files are not supported
+copy_fallback_errors = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                        errno.ENOTSUP, errno.EBADF)
+
+# Hash algorithms for the duplicate check, fastest first
+hash_algorithms = ('blake3', 'xxh3', 'blake2b', 'sha256')
+
+# Files up to this size are compared byte by byte instead of by checksum
+compare_size_limit = 256 << 20
+
+# ioctl request to clone a file on copy-on-write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Number of files queued per worker thread while walking the input directory
+pending_files_per_worker = 4
 
 
 class Phockup():
@@ -28,6 +64,7 @@ class Phockup():
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.dir_format = args.get('dir_format') or os.path.sep.join(['%Y', '%m', '%d'])
+        self.format_dir = compile_dir_format(self.dir_format)
         self.move = args.get('move', False)
         self.link = args.get('link', False)
         self.original_filenames = args.get('original_filenames', False)
@@ -36,9 +73,24 @@ class Phockup():
         self.date_field = args.get('date_field', False)
         self.dry_run = args.get('dry_run', False)
         self.max_depth = args.get('max_depth', -1)
-        self.stop_depth = self.input_dir.count(os.sep) + self.max_depth \
-            if self.max_depth > -1 else sys.maxsize
         self.file_type = args.get('file_type', None)
+        self.progress = args.get('progress', False)
+        self.reflink = args.get('reflink', True)
+        self.hash = args.get('hash') or next(
+            algorithm for algorithm in hash_algorithms if self.hash_available(algorithm))
+        self.max_workers = args.get('max_workers')
+        if self.max_workers is None:
+            self.max_workers = os.cpu_count() or 1
+        self.targets_lock = threading.Lock()
+        self.writing_targets = {}
+        self.created_dirs = set()
+        self.dir_listings = {}
+        self.target_checksums = {}
+
+        if not self.hash_available(self.hash):
+            raise RuntimeError(f"Hash algorithm '{self.hash}' is not available")
+        if self.max_workers < 1:
+            raise RuntimeError(f"Number of workers '{self.max_workers}' must be at least 1")
 
         if self.dry_run:
             logger.warning("Dry-run phockup (does a trial run with no permanent changes)...")
@@ -68,30 +120,207 @@ access!")
     def walk_directory(self):
         """
         Walk input directory recursively and call process_file for each file
-        except the ignored ones.
+        except the ignored ones and .xmp files, which are processed together
+        with their image. Files are processed by a pool of max_workers
+        threads while the walk continues, with a bounded number of files
+        queued.
         """
-        for root, dirnames, files in os.walk(self.input_dir):
-            files.sort()
-            for filename in files:
-                if filename in ignored_files:
+        window = self.max_workers * pending_files_per_worker
+        with Progress(self.progress) as progress, ExifToolDaemon(), \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            for filepath in self.iter_files():
+                if filepath.endswith('.xmp'):
                     continue
+                progress.file_found()
+                future = executor.submit(self.process_file, filepath)
+                future.add_done_callback(progress.file_processed)
+                pending.append(future)
+                if len(pending) >= window:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+
+    def iter_files(self):
+        """
+        Yield the paths of the files in the input directory and its
+        subdirectories up to max_depth, sorted by name in each directory.
+        Uses os.scandir so file types come from the directory listing
+        without an extra stat call per file.
+        """
+        # Local names for the lookups done for every entry
+        ignored = ignored_files
+        max_depth = self.max_depth
+        directories = [(self.input_dir, 0)]
+        while directories:
+            root, depth = directories.pop()
+            try:
+                with os.scandir(root) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError:
+                continue
+
+            subdirectories = []
+            for entry in entries:
+                if entry.is_dir():
+                    # Like os.walk, symlinks to directories are not followed
+                    if not entry.is_symlink():
+                        subdirectories.append((entry.path, depth + 1))
+                elif entry.name not in ignored:
+                    yield entry.path
 
-                filepath = os.path.join(root, filename)
-                self.process_file(filepath)
-            if root.count(os.sep) >= self.stop_depth:
-                del dirnames[:]
+            if max_depth == -1 or depth < max_depth:
+                directories.extend(reversed(subdirectories))
+
+    def hash_available(self, algorithm):
+        """
+        Check if the hash algorithm is known and its module is installed
+        """
+        if algorithm == 'blake3':
+            return blake3 is not None
+        if algorithm == 'xxh3':
+            return xxhash is not None
+        return algorithm in hash_algorithms
 
     def checksum(self, filename):
         """
-        Calculate checksum for a file.
+        Calculate checksum for a file using the selected hash algorithm.
         Used to match if duplicated file name is actually a duplicated file.
         """
-        block_size = 65536
-        sha256 = hashlib.sha256()
+        if self.hash == 'blake3':
+            hasher = blake3.blake3()
+            hasher.update_mmap(filename)
+            return hasher.hexdigest()
+
+        if self.hash == 'xxh3':
+            new_hasher = xxhash.xxh3_128
+        elif self.hash == 'sha256':
+            new_hasher = hashlib.sha256
+        else:
+            def new_hasher():
+                return hashlib.blake2b(digest_size=32)
+
         with open(filename, 'rb') as f:
-            for block in iter(lambda: f.read(block_size), b''):
-                sha256.update(block)
-        return sha256.hexdigest()
+            self.advise_sequential(f.fileno())
+            if sys.version_info >= (3, 11):
+                return hashlib.file_digest(f, new_hasher).hexdigest()
+
+            hasher = new_hasher()
+            buffer = memoryview(bytearray(1 << 20))
+            size = f.readinto(buffer)
+            while size:
+                hasher.update(buffer[:size])
+                size = f.readinto(buffer)
+        return hasher.hexdigest()
+
+    def advise_sequential(self, fd):
+        """
+        Tell the kernel that the whole file is going to be read sequentially,
+        so it reads ahead in larger requests while the data is processed.
+        """
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+
+    def target_checksum(self, target_file):
+        """
+        Calculate checksum for a file in the output directory. Files are not
+        changed once they are in the output, so each one is hashed only once.
+        """
+        checksum = self.target_checksums.get(target_file)
+        if checksum is None:
+            checksum = self.checksum(target_file)
+            self.target_checksums[target_file] = checksum
+        return checksum
+
+    def content_equal(self, filename, target_file):
+        """
+        Compare the content of two files.
+        The sizes and the first block are compared first. Files up to
+        compare_size_limit are then compared block by block, stopping at the
+        first difference. For larger files matching so far None is returned,
+        these are compared by checksum.
+        """
+        size = os.stat(filename).st_size
+        if size != os.stat(target_file).st_size:
+            return False
+
+        with open(filename, 'rb') as f1, open(target_file, 'rb') as f2:
+            if f1.read(65536) != f2.read(65536):
+                return False
+            if size > compare_size_limit:
+                return None
+
+            block_size = 1 << 20
+            while True:
+                block = f1.read(block_size)
+                if block != f2.read(block_size):
+                    return False
+                if not block:
+                    return True
+
+    def fast_copy(self, filename, target_file):
+        """
+        Copy file content and metadata like shutil.copy2, but fail with
+        FileExistsError instead of replacing an existing target.
+        The content is shared with a reflink if the file system supports it,
+        copied inside the kernel with copy_file_range or sendfile if
+        available, otherwise it is copied through user space.
+        """
+        with open(filename, 'rb') as fsrc, open(target_file, 'xb') as fdst:
+            try:
+                if not (self.reflink and self.clone(fsrc.fileno(), fdst.fileno())):
+                    self.advise_sequential(fsrc.fileno())
+                    if not self.copy_in_kernel(fsrc.fileno(), fdst.fileno()):
+                        shutil.copyfileobj(fsrc, fdst)
+            except BaseException:
+                # Do not leave a partial copy behind
+                fdst.close()
+                os.remove(target_file)
+                raise
+        shutil.copystat(filename, target_file)
+        return target_file
+
+    def clone(self, src_fd, dst_fd):
+        """
+        Make dst_fd a copy-on-write clone of src_fd, which only copies
+        metadata. Return False if the files are on different file systems
+        or the file system does not support it.
+        """
+        if fcntl is None or os.fstat(src_fd).st_dev != os.fstat(dst_fd).st_dev:
+            return False
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except OSError:
+            return False
+        return True
+
+    def copy_in_kernel(self, src_fd, dst_fd):
+        """
+        Copy from src_fd to dst_fd without passing the data through user
+        space. Return False if neither copy_file_range nor sendfile can be
+        used, the file offsets then point to where copying has to resume.
+        """
+        block_size = 1 << 30
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(src_fd, dst_fd, block_size):
+                    pass
+                return True
+            except OSError as e:
+                if e.errno not in copy_fallback_errors:
+                    raise
+        if sys.platform.startswith('linux') and hasattr(os, 'sendfile'):
+            try:
+                while os.sendfile(dst_fd, src_fd, None, block_size):
+                    pass
+                return True
+            except OSError as e:
+                if e.errno not in copy_fallback_errors:
+                    raise
+        return False
 
     def get_file_type(self, mimetype):
         """
@@ -99,12 +328,11 @@ access!")
         Return None if other
         Use mimetype to determine if the file is an image or video.
         """
-        patternImage = re.compile('^(image/.+|application/vnd.adobe.photoshop)$')
-        if patternImage.match(mimetype):
+        if mimetype.startswith('image/') \
+                or mimetype == 'application/vnd.adobe.photoshop':
             return 'image'
 
-        patternVideo = re.compile('^(video/.*)$')
-        if patternVideo.match(mimetype):
+        if mimetype.startswith('video/'):
             return 'video'
         return None
 
@@ -115,18 +343,59 @@ access!")
         If date is missing from the exifdata the file is going to "unknown"
         directory unless user included a regex from filename or uses timestamp.
         """
-        try:
-            path = [self.output_dir, date['date'].date().strftime(self.dir_format)]
-        except (TypeError, ValueError):
-            path = [self.output_dir, 'unknown']
-
-        fullpath = os.path.sep.join(path)
+        d = date.get('date') if date else None
+        # dir_rel is None if strftime rejects dir_format for the date
+        dir_rel = None if d is None else date.get('dir_rel') or self.format_dir(d)
+        if dir_rel is None:
+            fullpath = f'{self.output_dir}{os.sep}unknown'
+        else:
+            fullpath = f'{self.output_dir}{os.sep}{dir_rel}'
 
-        if not os.path.isdir(fullpath) and not self.dry_run:
-            os.makedirs(fullpath)
+        if fullpath not in self.created_dirs and not self.dry_run:
+            try:
+                os.makedirs(fullpath)
+                # A new directory is empty, so it does not have to be scanned
+                self.dir_listings.setdefault(fullpath, set())
+            except FileExistsError:
+                if not os.path.isdir(fullpath):
+                    raise
+            self.created_dirs.add(fullpath)
 
         return fullpath
 
+    def name_key(self, name):
+        """
+        Key of a file name in the directory listings. Names are matched
+        regardless of case and unicode normalization, so a name which may
+        exist on a case-insensitive or normalizing file system is found.
+        """
+        return unicodedata.normalize('NFC', name).casefold()
+
+    def get_dir_listing(self, output):
+        """
+        Return the keys of the files in the output directory. The directory
+        is scanned once, files written to it later are added to the listing.
+        """
+        names = self.dir_listings.get(output)
+        if names is None:
+            try:
+                with os.scandir(output) as entries:
+                    names = {self.name_key(entry.name) for entry in entries
+                             if entry.is_file()}
+            except FileNotFoundError:
+                names = set()
+            names = self.dir_listings.setdefault(output, names)
+        return names
+
+    def target_exists(self, output, target_file):
+        """
+        Check if the target file exists using the directory listing. Only a
+        name found in the listing is confirmed with a stat call.
+        """
+        names = self.get_dir_listing(output)
+        return self.name_key(os.path.basename(target_file)) in names \
+            and os.path.isfile(target_file)
+
     def get_file_name(self, original_filename, date):
         """
         Generate file name based on exif data unless it is missing or
@@ -135,72 +404,59 @@ access!")
         if self.original_filenames:
             return os.path.basename(original_filename)
 
-        try:
-            filename = [
-                f'{(date["date"].year):04d}',
-                f'{(date["date"].month):02d}',
-                f'{(date["date"].day):02d}',
-                '-',
-                f'{(date["date"].hour):02d}',
-                f'{(date["date"].minute):02d}',
-                f'{(date["date"].second):02d}',
-            ]
-
-            if date['subseconds']:
-                filename.append(date['subseconds'])
-
-            return ''.join(filename) + os.path.splitext(original_filename)[1]
-        # TODO: Double check if this is correct!
-        except TypeError:
+        d = date.get('date') if date else None
+        if d is None:
             return os.path.basename(original_filename)
 
+        prefix = date.get('fn_prefix') or format_file_name(d)
+        return f"{prefix}{date.get('subseconds') or ''}{os.path.splitext(original_filename)[1]}"
+
     def process_file(self, filename):
         """
         Process the file using the selected strategy
         If file is .xmp skip it so process_xmp method can handle it
         """
-        if str.endswith(filename, '.xmp'):
+        if filename.endswith('.xmp'):
             return None
 
         progress = f'{filename}'
 
         output, target_file_name, target_file_path, target_file_type = self.get_file_name_and_path(filename)
 
+        if self.file_type is not None \
+                and self.file_type != target_file_type:
+            progress = f"{progress} => skipped, file is '{target_file_type}' \
+but looking for '{self.file_type}'"
+            logger.info(progress)
+            return None
+
         suffix = 1
         target_file = target_file_path
+        checksum = None
 
         while True:
-            if self.file_type is not None \
-                    and self.file_type != target_file_type:
-                progress = f"{progress} => skipped, file is '{target_file_type}' \
-but looking for '{self.file_type}'"
-                logger.info(progress)
-                break
-
-            if os.path.isfile(target_file):
-                if self.checksum(filename) == self.checksum(target_file):
-                    progress = f'{progress} => skipped, duplicated file {target_file}'
-                    logger.info(progress)
+            reserved, writing = self.reserve_target(output, target_file)
+            if reserved:
+                taken = True
+                try:
+                    self.write_target(filename, target_file)
+                except FileExistsError:
+                    # Created by someone else since the directory was scanned,
+                    # check it as an existing file
+                    continue
+                except FileNotFoundError:
+                    taken = False
+                    progress = f'{progress} => skipped, no such file or directory'
+                    logger.warning(progress)
                     break
-            else:
-                if self.move:
-                    try:
-                        if not self.dry_run:
-                            shutil.move(filename, target_file)
-                    except FileNotFoundError:
-                        progress = f'{progress} => skipped, no such file or directory'
-                        logger.warning(progress)
-                        break
-                elif self.link and not self.dry_run:
-                    os.link(filename, target_file)
-                else:
-                    try:
-                        if not self.dry_run:
-                            shutil.copy2(filename, target_file)
-                    except FileNotFoundError:
-                        progress = f'{progress} => skipped, no such file or directory'
-                        logger.warning(progress)
-                        break
+                except BaseException:
+                    taken = False
+                    raise
+                finally:
+                    self.release_target(output, target_file, taken)
+
+                if checksum and not self.dry_run:
+                    self.target_checksums[target_file] = checksum
 
                 progress = f'{progress} => {target_file}'
                 logger.info(progress)
@@ -208,10 +464,90 @@ but looking for '{self.file_type}'"
                 self.process_xmp(filename, target_file_name, suffix, output)
                 break
 
+            if writing is not None:
+                # Another thread is writing this target, check it once it is done
+                writing.wait()
+                continue
+
+            duplicate = self.content_equal(filename, target_file)
+            if duplicate is None:
+                # The source checksum is calculated once for all suffixes
+                checksum = checksum or self.checksum(filename)
+                duplicate = checksum == self.target_checksum(target_file)
+            if duplicate:
+                progress = f'{progress} => skipped, duplicated file {target_file}'
+                logger.info(progress)
+                break
+
             suffix += 1
             target_split = os.path.splitext(target_file_path)
             target_file = f'{target_split[0]}-{suffix}{target_split[1]}'
 
+    def reserve_target(self, output, target_file):
+        """
+        Reserve the target file name for writing if it is free.
+        Returns (True, None) if it was reserved. Otherwise returns False and
+        the event of the thread writing the target, or None if the target
+        already exists.
+        """
+        key = (output, self.name_key(os.path.basename(target_file)))
+        with self.targets_lock:
+            writing = self.writing_targets.get(key)
+            if writing is not None:
+                return False, writing
+            if self.target_exists(output, target_file):
+                return False, None
+
+            self.writing_targets[key] = threading.Event()
+            if not self.dry_run:
+                self.get_dir_listing(output).add(key[1])
+            return True, None
+
+    def release_target(self, output, target_file, taken):
+        """
+        Finish writing a reserved target. If the file was not written the
+        name is free again. Wakes up threads waiting for the target.
+        """
+        key = (output, self.name_key(os.path.basename(target_file)))
+        with self.targets_lock:
+            writing = self.writing_targets.pop(key)
+            if not taken:
+                self.get_dir_listing(output).discard(key[1])
+        writing.set()
+
+    def write_target(self, filename, target_file):
+        """
+        Copy, move or link the file to the target using the selected
+        strategy. Never replaces an existing target, FileExistsError is
+        raised instead.
+        """
+        if self.dry_run:
+            return
+        if self.move:
+            self.move_file(filename, target_file)
+        elif self.link:
+            os.link(filename, target_file)
+        else:
+            self.fast_copy(filename, target_file)
+
+    def move_file(self, filename, target_file):
+        """
+        Move the file without replacing an existing target. A hard link is
+        made and the original removed. Across file systems the file is
+        copied; where the file system does not support hard links it is
+        renamed, the target name being reserved by process_file.
+        """
+        try:
+            os.link(filename, target_file)
+        except (FileExistsError, FileNotFoundError):
+            raise
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                os.rename(filename, target_file)
+                return
+            self.fast_copy(filename, target_file)
+        os.remove(filename)
+
     def get_file_name_and_path(self, filename):
         """
         Returns target file name and path
@@ -223,17 +559,17 @@ but looking for '{self.file_type}'"
             target_file_type = self.get_file_type(exif_data['MIMEType'])
 
         if target_file_type in ['image', 'video']:
-            date = Date(filename).from_exif(exif_data, self.timestamp, self.date_regex,
-                                            self.date_field)
+            date = Date(filename, self.dir_format).from_exif(
+                exif_data, self.timestamp, self.date_regex, self.date_field)
             output = self.get_output_dir(date)
             target_file_name = self.get_file_name(filename, date)
             if not self.original_filenames:
                 target_file_name = target_file_name.lower()
-            target_file_path = os.path.sep.join([output, target_file_name])
+            target_file_path = f'{output}{os.sep}{target_file_name}'
         else:
             output = self.get_output_dir(False)
             target_file_name = os.path.basename(filename)
-            target_file_path = os.path.sep.join([output, target_file_name])
+            target_file_path = f'{output}{os.sep}{target_file_name}'
 
         return output, target_file_name, target_file_path, target_file_type
 
@@ -256,13 +592,10 @@ but looking for '{self.file_type}'"
             xmp_files[xmp_original_without_ext] = xmp_target
 
         for original, target in xmp_files.items():
-            xmp_path = os.path.sep.join([output, target])
+            xmp_path = f'{output}{os.sep}{target}'
+            try:
+                self.write_target(original, xmp_path)
+            except FileExistsError:
+                logger.warning(f'{original} => skipped, file {xmp_path} exists')
+                continue
             logger.info(f'{original} => {xmp_path}')
-
-            if not self.dry_run:
-                if self.move:
-                    shutil.move(original, xmp_path)
-                elif self.link:
-                    os.link(original, xmp_path)
-                else:
-                    shutil.copy2(original, xmp_path)
@@ -0,0 +1,83 @@
+import logging
+import sys
+import threading
+
+
+class Progress(object):
+    """
+    Show the number of processed files on a single status line.
+    Worker threads only update counters, the line is redrawn by a
+    background thread at most 30 times per second.
+    """
+    interval = 1 / 30
+    active = None
+
+    def __init__(self, show=True, stream=None):
+        self.show = show
+        self.stream = stream or sys.stderr
+        self.found = 0
+        self.processed = 0
+        self.lock = threading.Lock()
+        self.stream_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.line = None
+
+    def __enter__(self):
+        if self.show:
+            Progress.active = self
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.show:
+            self.stopped.set()
+            self.thread.join()
+            with self.stream_lock:
+                Progress.active = None
+                self.write()
+                self.stream.write('\n')
+                self.stream.flush()
+
+    def file_found(self):
+        with self.lock:
+            self.found += 1
+
+    def file_processed(self, *args):
+        with self.lock:
+            self.processed += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.stream_lock:
+                self.write()
+
+    def write(self):
+        line = f'\rProcessed {self.processed} of {self.found} files'
+        if line != self.line:
+            self.stream.write(line)
+            self.stream.flush()
+            self.line = line
+
+    def clear(self):
+        """
+        Erase the status line, it is drawn again on the next update.
+        """
+        if self.line is not None:
+            self.stream.write('\r\x1b[K')
+            self.line = None
+
+
+class ProgressHandler(logging.StreamHandler):
+    """
+    Stream handler which clears the status line of the active Progress
+    before writing a record, so the record starts on its own line.
+    """
+
+    def emit(self, record):
+        progress = Progress.active
+        if progress is None or progress.stream is not self.stream:
+            return super().emit(record)
+        with progress.stream_lock:
+            progress.clear()
+            super().emit(record)
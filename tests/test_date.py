@@ -2,7 +2,7 @@
 import os
 import re
 from datetime import datetime
-from src.date import Date
+from src.date import Date, compile_dir_format, format_file_name
 
 os.chdir(os.path.dirname(__file__))
 
@@ -15,6 +15,37 @@ def test_parse_date_format_valid():
     )
 
 
+def test_compile_dir_format():
+    date = datetime(2017, 1, 2, 3, 4, 5)
+    for dir_format in ['%Y/%m/%d', '%Y\\%m\\%d', "%y-%m-%d {it's} %%", '%Y/%b', '%B %d']:
+        format_dir = compile_dir_format(dir_format)
+        assert format_dir(date) == date.date().strftime(dir_format)
+
+
+def test_compile_dir_format_rejected_by_strftime(mocker):
+    date = mocker.Mock()
+    date.date.return_value.strftime.side_effect = ValueError('Invalid format string')
+    assert compile_dir_format('%Y/%b')(date) is None
+
+
+def test_format_file_name():
+    assert format_file_name(datetime(2017, 1, 2, 3, 4, 5)) == '20170102-030405'
+    # strftime('%Y') does not zero-pad years below 1000 on every platform
+    assert format_file_name(datetime(999, 1, 1, 1, 1, 1)) == '09990101-010101'
+    assert format_file_name(datetime(1, 1, 1)) == '00010101-000000'
+
+
+def test_get_date_from_exif_with_dir_format():
+    assert Date(dir_format='%Y/%m').from_exif({
+        "CreateDate": "2017-01-01 01:01:01"
+    }) == {
+               "date": datetime(2017, 1, 1, 1, 1, 1),
+               "subseconds": "",
+               "dir_rel": "2017/01",
+               "fn_prefix": "20170101-010101"
+           }
+
+
 def test_get_date_from_exif():
     assert Date().from_exif({
         "CreateDate": "2017-01-01 01:01:01"
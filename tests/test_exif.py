@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import os
-from subprocess import CalledProcessError
-from src.exif import Exif
+import pytest
+import sys
+from subprocess import PIPE, CalledProcessError, Popen
+from src.exif import Exif, ExifToolDaemon
 
 os.chdir(os.path.dirname(__file__))
 
@@ -26,3 +28,38 @@ def test_exif_handles_exception(mocker):
                  side_effect=CalledProcessError(2, 'cmd'))
     exif = Exif("not-existing.jpg")
     assert exif.data() is None
+
+
+def test_exif_daemon_reads_valid_file():
+    with ExifToolDaemon():
+        exif = Exif("input/phockup's exif test.jpg")
+        assert exif.data()['CreateDate'] == '2017:01:01 01:01:01'
+
+
+def test_exif_daemon_accepts():
+    daemon = ExifToolDaemon()
+    assert daemon.accepts("input/phockup's exif test.jpg")
+    assert not daemon.accepts("-input.jpg")
+    assert not daemon.accepts("#input.jpg")
+    assert not daemon.accepts("input.jpg ")
+    assert not daemon.accepts("in\nput.jpg")
+
+
+def test_exif_daemon_falls_back_on_error(mocker):
+    mocker.patch.object(ExifToolDaemon, 'data', side_effect=BrokenPipeError)
+    mocker.patch('src.exif.check_output', return_value=b'[{"MIMEType": "image/jpeg"}]')
+    with ExifToolDaemon():
+        assert Exif("input/exif.jpg").data() == {'MIMEType': 'image/jpeg'}
+
+
+def test_exif_daemon_process_exited():
+    daemon = ExifToolDaemon()
+    process = Popen([sys.executable, '-c', 'import sys; sys.stdout.write("[{")'],
+                    stdin=PIPE, stdout=PIPE)
+    process.wait()
+    daemon.local.process = process
+    daemon.processes.append(process)
+    with pytest.raises(OSError):
+        daemon.data("input/exif.jpg")
+    assert daemon.local.process is None
+    daemon.close()
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
+import hashlib
 import pytest
 import shutil
 import sys
 import os
+import time
 import logging
 from datetime import datetime
 from src.dependency import check_dependencies
@@ -80,6 +82,69 @@ def test_walking_directory():
     shutil.rmtree('output', ignore_errors=True)
 
 
+def test_setup_logging(mocker, capsys, tmp_path):
+    import phockup
+    stops = []
+    mocker.patch('atexit.register', side_effect=stops.append)
+    root = logging.getLogger('')
+    root_handlers, root_level = list(root.handlers), root.level
+    log = logging.getLogger('phockup')
+    log_handlers, log_level = list(log.handlers), log.level
+    logfile = tmp_path / 'phockup.log'
+    try:
+        phockup.setup_logging(phockup.parse_args(
+            ['--progress', f'--log={logfile}', 'input', 'output']))
+        log.info('info message')
+        log.warning('warning message')
+        for stop in stops:
+            stop()
+    finally:
+        root.handlers[:], log.handlers[:] = root_handlers, log_handlers
+        root.setLevel(root_level)
+        log.setLevel(log_level)
+    assert len(stops) == 2
+    console = capsys.readouterr().err
+    assert 'info message' not in console
+    assert 'warning message' in console
+    written = logfile.read_text()
+    assert 'info message' in written
+    assert 'warning message' in written
+
+
+def test_walking_directory_max_workers(mocker):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'process_file')
+    phockup = Phockup('input', 'output', max_workers=2)
+    assert phockup.max_workers == 2
+    processed = [call[0][0] for call in Phockup.process_file.call_args_list]
+    assert os.path.join('input', 'exif.jpg') in processed
+    assert os.path.join('input', 'sub_folder', 'date_20180101_010101.jpg') in processed
+    assert len(processed) == len(set(processed))
+    assert not [f for f in processed if f.endswith('.xmp')]
+
+
+def test_iter_files(mocker):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    files = list(Phockup('input', 'output').iter_files())
+    top_level = [f for f in files if os.path.dirname(f) == 'input']
+    assert top_level == sorted(top_level)
+    assert '.DS_Store' not in [os.path.basename(f) for f in files]
+    assert os.path.join('input', 'exif.jpg') in files
+    assert os.path.join('input', 'sub_folder', 'date_20180101_010101.jpg') in files
+    files = list(Phockup('input', 'output', max_depth=0).iter_files())
+    assert os.path.join('input', 'exif.jpg') in files
+    assert os.path.join('input', 'sub_folder', 'date_20180101_010101.jpg') not in files
+
+
+def test_max_workers_must_be_positive(mocker):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    with pytest.raises(RuntimeError, match="Number of workers '0' must be at least 1"):
+        Phockup('input', 'output', max_workers=0)
+    assert Phockup('input', 'output').max_workers >= 1
+
+
 def test_dry_run():
     shutil.rmtree('output', ignore_errors=True)
     Phockup('input', 'output', dry_run=True)
@@ -98,9 +163,35 @@ def test_get_file_type(mocker):
     mocker.patch.object(Phockup, 'check_directories')
     assert Phockup('in', '.').get_file_type("image/jpeg")
     assert Phockup('in', '.').get_file_type("video/mp4")
+    assert Phockup('in', '.').get_file_type("application/vnd.adobe.photoshop") == 'image'
     assert not Phockup('in', '.').get_file_type("foo/bar")
 
 
+def test_get_output_dir_unknown(mocker):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    phockup = Phockup('in', 'out', dry_run=True)
+    expected = os.path.join('out', 'unknown')
+    assert phockup.get_output_dir(None) == expected
+    assert phockup.get_output_dir(False) == expected
+    assert phockup.get_output_dir({'date': None, 'subseconds': ''}) == expected
+    assert phockup.get_output_dir({'date': datetime(2017, 1, 1), 'subseconds': ''}) == \
+        os.path.join('out', '2017', '01', '01')
+    assert phockup.get_output_dir({'date': datetime(2017, 1, 1), 'subseconds': '',
+                                   'dir_rel': os.path.join('2018', '02')}) == \
+        os.path.join('out', '2018', '02')
+
+
+def test_get_output_dir_rejected_by_strftime(mocker):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    date = mocker.Mock()
+    date.date.return_value.strftime.side_effect = ValueError('Invalid format string')
+    phockup = Phockup('in', 'out', dir_format='%Y/%b', dry_run=True)
+    assert phockup.get_output_dir({'date': date, 'subseconds': ''}) == \
+        os.path.join('out', 'unknown')
+
+
 def test_get_file_name(mocker):
     mocker.patch.object(Phockup, 'check_directories')
     mocker.patch.object(Phockup, 'walk_directory')
@@ -111,12 +202,23 @@ def test_get_file_name(mocker):
 
     assert Phockup('in', 'out').get_file_name("Bar/Foo.jpg", date) == \
         "20170101-01010120.jpg"
+    date = {
+        "date": datetime(999, 1, 1, 1, 1, 1),
+        "subseconds": ""
+    }
+    assert Phockup('in', 'out').get_file_name("Bar/Foo.jpg", date) == \
+        "09990101-010101.jpg"
 
 
 def test_get_file_name_is_original_on_exception(mocker):
     mocker.patch.object(Phockup, 'check_directories')
     mocker.patch.object(Phockup, 'walk_directory')
     assert Phockup('in', 'out').get_file_name("Bar/Foo.jpg", None) == "Foo.jpg"
+    date = {
+        "date": None,
+        "subseconds": ""
+    }
+    assert Phockup('in', 'out').get_file_name("Bar/Foo.jpg", date) == "Foo.jpg"
 
 
 def test_process_file_with_filename_date(mocker):
@@ -297,6 +399,220 @@ def test_process_same_date_different_files_rename(mocker):
     shutil.rmtree('output', ignore_errors=True)
 
 
+def test_checksum(mocker):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    with open('input/exif.jpg', 'rb') as f:
+        data = f.read()
+    phockup = Phockup('input', 'output', hash='blake2b')
+    assert phockup.checksum('input/exif.jpg') == \
+        hashlib.blake2b(data, digest_size=32).hexdigest()
+    phockup = Phockup('input', 'output', hash='sha256')
+    assert phockup.checksum('input/exif.jpg') == hashlib.sha256(data).hexdigest()
+
+
+@pytest.mark.parametrize('algorithm', ['blake3', 'xxh3'])
+def test_checksum_optional_hash(mocker, algorithm):
+    pytest.importorskip({'blake3': 'blake3', 'xxh3': 'xxhash'}[algorithm])
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    phockup = Phockup('input', 'output', hash=algorithm)
+    assert phockup.checksum('input/exif.jpg') == phockup.checksum('input/exif.jpg')
+    assert phockup.checksum('input/exif.jpg') != phockup.checksum('input/other.txt')
+
+
+def test_hash_not_available(mocker):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    mocker.patch('src.phockup.blake3', None)
+    with pytest.raises(RuntimeError, match="Hash algorithm 'blake3' is not available"):
+        Phockup('input', 'output', hash='blake3')
+    assert Phockup('input', 'output').hash != 'blake3'
+
+
+def test_content_equal(mocker, tmp_path):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    phockup = Phockup('input', 'output')
+    (tmp_path / 'a').write_bytes(b'foo' * 1000000)
+    (tmp_path / 'b').write_bytes(b'foo' * 1000000)
+    (tmp_path / 'c').write_bytes(b'foo' * 999999 + b'bar')
+    (tmp_path / 'd').write_bytes(b'bar' + b'foo' * 999999)
+    (tmp_path / 'e').write_bytes(b'foo')
+    (tmp_path / 'f').write_bytes(b'')
+    (tmp_path / 'g').write_bytes(b'')
+    assert phockup.content_equal(str(tmp_path / 'a'), str(tmp_path / 'b')) is True
+    assert phockup.content_equal(str(tmp_path / 'a'), str(tmp_path / 'c')) is False
+    assert phockup.content_equal(str(tmp_path / 'a'), str(tmp_path / 'd')) is False
+    assert phockup.content_equal(str(tmp_path / 'a'), str(tmp_path / 'e')) is False
+    assert phockup.content_equal(str(tmp_path / 'f'), str(tmp_path / 'g')) is True
+    mocker.patch('src.phockup.compare_size_limit', 0)
+    assert phockup.content_equal(str(tmp_path / 'a'), str(tmp_path / 'b')) is None
+    assert phockup.content_equal(str(tmp_path / 'a'), str(tmp_path / 'c')) is None
+    assert phockup.content_equal(str(tmp_path / 'a'), str(tmp_path / 'd')) is False
+
+
+def test_process_exists_same_large_file(mocker, caplog):
+    shutil.rmtree('output', ignore_errors=True)
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    mocker.patch.object(Exif, 'data')
+    Exif.data.return_value = {
+        "MIMEType": "image/jpeg"
+    }
+    mocker.patch('src.phockup.compare_size_limit', 0)
+    mocker.spy(Phockup, 'checksum')
+    phockup = Phockup('input', 'output')
+    phockup.process_file("input/date_20170101_010101.jpg")
+    with caplog.at_level(logging.INFO):
+        phockup.process_file("input/date_20170101_010101.jpg")
+    assert 'skipped, duplicated file' in caplog.text
+    assert Phockup.checksum.call_count == 2
+    with caplog.at_level(logging.INFO):
+        phockup.process_file("input/date_20170101_010101.jpg")
+    assert Phockup.checksum.call_count == 3
+    shutil.rmtree('output', ignore_errors=True)
+
+
+def test_fast_copy(mocker, tmp_path):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    target = str(tmp_path / 'exif.jpg')
+    Phockup('input', 'output').fast_copy('input/exif.jpg', target)
+    with open('input/exif.jpg', 'rb') as f1, open(target, 'rb') as f2:
+        assert f1.read() == f2.read()
+    assert os.stat(target).st_mtime == os.stat('input/exif.jpg').st_mtime
+
+
+def test_fast_copy_without_kernel_copy(mocker, tmp_path):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    mocker.patch.object(Phockup, 'copy_in_kernel', return_value=False)
+    target = str(tmp_path / 'exif.jpg')
+    Phockup('input', 'output').fast_copy('input/exif.jpg', target)
+    with open('input/exif.jpg', 'rb') as f1, open(target, 'rb') as f2:
+        assert f1.read() == f2.read()
+
+
+def test_fast_copy_and_move_do_not_replace(mocker, tmp_path):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    phockup = Phockup('input', 'output')
+    (tmp_path / 'source').write_bytes(b'source')
+    (tmp_path / 'target').write_bytes(b'target')
+    with pytest.raises(FileExistsError):
+        phockup.fast_copy(str(tmp_path / 'source'), str(tmp_path / 'target'))
+    with pytest.raises(FileExistsError):
+        phockup.move_file(str(tmp_path / 'source'), str(tmp_path / 'target'))
+    assert (tmp_path / 'source').read_bytes() == b'source'
+    assert (tmp_path / 'target').read_bytes() == b'target'
+
+
+def test_move_file_across_file_systems(mocker, tmp_path):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    mocker.patch('os.link', side_effect=OSError(18, 'Invalid cross-device link'))
+    (tmp_path / 'source').write_bytes(b'source')
+    Phockup('input', 'output').move_file(str(tmp_path / 'source'), str(tmp_path / 'target'))
+    assert not (tmp_path / 'source').exists()
+    assert (tmp_path / 'target').read_bytes() == b'source'
+
+
+def test_move_file_without_hard_links(mocker, tmp_path):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    mocker.patch.object(Phockup, 'fast_copy')
+    mocker.patch('os.link', side_effect=OSError(1, 'Operation not permitted'))
+    (tmp_path / 'source').write_bytes(b'source')
+    Phockup('input', 'output').move_file(str(tmp_path / 'source'), str(tmp_path / 'target'))
+    assert not Phockup.fast_copy.called
+    assert not (tmp_path / 'source').exists()
+    assert (tmp_path / 'target').read_bytes() == b'source'
+
+
+def test_fast_copy_without_reflink(mocker, tmp_path):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    mocker.patch.object(Phockup, 'clone')
+    target = str(tmp_path / 'exif.jpg')
+    Phockup('input', 'output', reflink=False).fast_copy('input/exif.jpg', target)
+    assert not Phockup.clone.called
+    assert os.path.getsize(target) == os.path.getsize('input/exif.jpg')
+
+
+def test_process_existing_target_rename(mocker):
+    shutil.rmtree('output', ignore_errors=True)
+    os.makedirs('output/2017/01/01')
+    open('output/2017/01/01/20170101-010101.jpg', 'w').close()
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    mocker.patch.object(Exif, 'data')
+    Exif.data.return_value = {
+        "MIMEType": "image/jpeg"
+    }
+    phockup = Phockup('input', 'output')
+    phockup.process_file("input/date_20170101_010101.jpg")
+    assert os.path.isfile("output/2017/01/01/20170101-010101-2.jpg")
+    assert os.path.join('output', '2017', '01', '01') in phockup.dir_listings
+    phockup.process_file("input/sub_folder/date_20180101_010101.jpg")
+    listing = phockup.dir_listings[os.path.join('output', '2018', '01', '01')]
+    assert listing == {'20180101-010101.jpg'}
+    shutil.rmtree('output', ignore_errors=True)
+
+
+def test_new_output_dir_is_not_scanned(mocker):
+    shutil.rmtree('output', ignore_errors=True)
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    mocker.patch.object(Exif, 'data')
+    Exif.data.return_value = {
+        "MIMEType": "image/jpeg"
+    }
+    scandir = mocker.spy(os, 'scandir')
+    Phockup('input', 'output').process_file("input/date_20170101_010101.jpg")
+    assert os.path.isfile("output/2017/01/01/20170101-010101.jpg")
+    assert not scandir.called
+    shutil.rmtree('output', ignore_errors=True)
+
+
+@pytest.mark.parametrize('mode', [{}, {'move': True}, {'link': True}])
+def test_concurrent_suffix_collision(mocker, tmp_path, mode):
+    # photo.jpg from b gets suffix -2 while c/photo-2.jpg is being written
+    for directory, content in [('a', b'a'), ('b', b'b'), ('c', b'c')]:
+        os.makedirs(str(tmp_path / 'in' / directory))
+        name = 'photo-2.jpg' if directory == 'c' else 'photo.jpg'
+        (tmp_path / 'in' / directory / name).write_bytes(content)
+    mocker.patch.object(Exif, 'data', return_value={"MIMEType": "text/plain"})
+    fast_copy = Phockup.fast_copy
+    link = os.link
+
+    def delay(src):
+        time.sleep(0.3 if os.path.basename(src) == 'photo-2.jpg' else 0.05)
+
+    def slow_fast_copy(self, src, dst):
+        delay(src)
+        return fast_copy(self, src, dst)
+
+    def slow_link(src, dst):
+        delay(src)
+        return link(src, dst)
+
+    mocker.patch.object(Phockup, 'fast_copy', slow_fast_copy)
+    mocker.patch('os.link', slow_link)
+    Phockup(str(tmp_path / 'in'), str(tmp_path / 'out'), max_workers=4, **mode)
+    output = tmp_path / 'out' / 'unknown'
+    contents = sorted(path.read_bytes() for path in output.iterdir())
+    assert contents == [b'a', b'b', b'c']
+
+
+def test_name_key(mocker):
+    mocker.patch.object(Phockup, 'check_directories')
+    mocker.patch.object(Phockup, 'walk_directory')
+    phockup = Phockup('input', 'output')
+    assert phockup.name_key('IMG.JPG') == phockup.name_key('img.jpg')
+    assert phockup.name_key('e\u0301.jpg') == phockup.name_key('\u00e9.jpg')
+
+
 def test_process_skip_xmp(mocker):
     # Assume no errors == skip XMP file
     mocker.patch.object(Phockup, 'check_directories')
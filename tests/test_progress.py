@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+import io
+import logging
+
+from src.progress import Progress, ProgressHandler
+
+
+def test_progress_counts_files():
+    stream = io.StringIO()
+    with Progress(stream=stream) as progress:
+        progress.file_found()
+        progress.file_found()
+        progress.file_processed()
+    progress.file_processed()
+    assert progress.found == 2
+    assert progress.processed == 2
+    assert stream.getvalue().endswith('\rProcessed 1 of 2 files\n')
+
+
+def test_progress_hidden():
+    stream = io.StringIO()
+    with Progress(False, stream=stream) as progress:
+        progress.file_found()
+        progress.file_processed()
+    assert stream.getvalue() == ''
+
+
+def test_progress_handler_clears_status_line():
+    stream = io.StringIO()
+    handler = ProgressHandler(stream)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    record = logging.makeLogRecord({'msg': 'warning'})
+    with Progress(stream=stream) as progress:
+        progress.file_found()
+        with progress.stream_lock:
+            progress.write()
+        handler.emit(record)
+    assert stream.getvalue() == (
+        '\rProcessed 0 of 1 files\r\x1b[Kwarning\n\rProcessed 0 of 1 files\n')
+    handler.emit(record)
+    assert stream.getvalue().endswith('files\nwarning\n')